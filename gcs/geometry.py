@@ -1,10 +1,24 @@
+import math
+from functools import lru_cache
+
 import numpy as np
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import CartesianRepresentation, SkyCoord
 from numpy import pi, sin, cos, tan, arcsin, sqrt
-from numpy.linalg import norm
-from scipy.spatial.transform import Rotation
 from sunpy.coordinates import frames, sun
 
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it the mesh is computed and projected using plain NumPy
+    njit = None
+
+
+def _sincos(x):
+    """
+    Sine and cosine of the same angle(s), evaluated back to back.
+    """
+    return sin(x), cos(x)
+
 
 def skeleton(alpha, distjunc, straight_vertices, front_vertices, k):
     """
@@ -30,26 +44,31 @@ def skeleton(alpha, distjunc, straight_vertices, front_vertices, k):
 
     gamma = arcsin(k)
 
+    sin_alpha, cos_alpha = _sincos(alpha)
+
     # calculate the points of the straight line part
-    pRstart = np.array([0, sin(alpha), cos(alpha)])  # start on the limb
-    pLstart = np.array([0, -sin(alpha), cos(alpha)])
-    pslR = np.outer(np.linspace(0, distjunc, straight_vertices), np.array([0, sin(alpha), cos(alpha)]))
-    pslL = np.outer(np.linspace(0, distjunc, straight_vertices), np.array([0, -sin(alpha), cos(alpha)]))
-    rsl = tan(gamma) * norm(pslR, axis=1)
+    pRstart = np.array([0, sin_alpha, cos_alpha])  # start on the limb
+    pLstart = np.array([0, -sin_alpha, cos_alpha])
+    # distance of each point from the origin, as the directions are unit vectors
+    dsl = np.linspace(0, distjunc, straight_vertices)
+    pslR = dsl[:, np.newaxis] * np.array([0, sin_alpha, cos_alpha])
+    pslL = dsl[:, np.newaxis] * np.array([0, -sin_alpha, cos_alpha])
+    rsl = tan(gamma) * dsl
     casl = np.full(straight_vertices, -alpha)
 
     # calculate the points of the circular part
     beta = np.linspace(-alpha, pi / 2, front_vertices)
     hf = distjunc
-    h = hf / cos(alpha)
+    h = hf / cos_alpha
     rho = hf * tan(alpha)
 
-    X0 = (rho + h * k ** 2 * sin(beta)) / (1 - k ** 2)
+    sin_beta, cos_beta = _sincos(beta)
+    X0 = (rho + h * k ** 2 * sin_beta) / (1 - k ** 2)
     rc = sqrt((h ** 2 * k ** 2 - rho ** 2) / (1 - k ** 2) + X0 ** 2)
     cac = beta
 
-    pcR = np.array([np.zeros(beta.shape), X0 * cos(beta), h + X0 * sin(beta)]).T
-    pcL = np.array([np.zeros(beta.shape), -X0 * cos(beta), h + X0 * sin(beta)]).T
+    pcR = np.array([np.zeros(beta.shape), X0 * cos_beta, h + X0 * sin_beta]).T
+    pcL = np.array([np.zeros(beta.shape), -X0 * cos_beta, h + X0 * sin_beta]).T
 
     r = np.concatenate((rsl, rc[1:], np.flipud(rc)[1:], np.flipud(rsl)[1:]))
     ca = np.concatenate((casl, cac[1:], pi-np.flipud(cac)[1:], pi-np.flipud(casl)[1:]))
@@ -58,7 +77,7 @@ def skeleton(alpha, distjunc, straight_vertices, front_vertices, k):
     return p, r, ca
 
 
-def gcs_mesh(alpha, height, straight_vertices, front_vertices, circle_vertices, k):
+def gcs_mesh(alpha, height, straight_vertices, front_vertices, circle_vertices, k, dtype=np.float64, out=None):
     """
     Calculate GCS model mesh. Based on IDL version cmecloud.pro.
     https://hesperia.gsfc.nasa.gov/ssw/stereo/secchi/idl/scraytrace/cmecloud.pro
@@ -71,6 +90,9 @@ def gcs_mesh(alpha, height, straight_vertices, front_vertices, circle_vertices,
     front_vertices: number of vertices along front
     circle_vertices: number of vertices along each circle
     k: GCS ratio
+    dtype: data type of the mesh. np.float32 is precise enough for displaying the mesh.
+    out: optional array of shape (number of mesh points, 3) that the mesh is written to, e.g. to reuse it between
+         calls. If given, dtype is ignored.
 
     Returns
     -------
@@ -78,30 +100,78 @@ def gcs_mesh(alpha, height, straight_vertices, front_vertices, circle_vertices,
     - Z axis: Sun-Earth line projected onto Sun's equatorial plane
     - Y axis: Sun's north pole
     - Origin: center of the Sun
+    u, v: angle along the circles and index along the skeleton of each mesh point (read-only, shared between calls)
 
     """
     # calculate position
 
     # calculate height of skeleton depending on height of leading edge
-    distjunc = height *(1-k)*cos(alpha)/(1.+sin(alpha))
+    sin_alpha, cos_alpha = _sincos(alpha)
+    distjunc = height *(1-k)*cos_alpha/(1.+sin_alpha)
     p, r, ca = skeleton(alpha, distjunc, straight_vertices, front_vertices, k)
 
+    sin_u, cos_u, u, v = _mesh_indices(straight_vertices, front_vertices, circle_vertices)
+
+    if out is None:
+        out = np.empty((len(u), 3), dtype=dtype)
+    _mesh_points(p, r, ca, sin_u, cos_u, out)
+
+    return out, u, v
+
+
+@lru_cache(maxsize=8)
+def _mesh_indices(straight_vertices, front_vertices, circle_vertices):
+    """
+    Angles along the circles of the mesh and the (u, v) grid of the mesh points, which only depend on the number of
+    vertices. The returned arrays are read-only, as they are shared between calls.
+    """
     theta = np.linspace(0, 2 * pi, circle_vertices)
     pspace = np.arange(0, (front_vertices + straight_vertices) * 2 - 3)
     u, v = np.meshgrid(theta, pspace)
     u, v = u.flatten(), v.flatten()
+    sin_u, cos_u = _sincos(theta)
+    for arr in sin_u, cos_u, u, v:
+        arr.setflags(write=False)
+    return sin_u, cos_u, u, v
 
-    mesh = r[v, np.newaxis] * np.array([cos(u), sin(u) * cos(ca[v]), sin(u) * sin(ca[v])]).T + p[v]
 
-    # mesh = np.concatenate([
-    #    r * np.array([costheta, sintheta * cos(ca), sintheta * sin(ca)]).T + np.array([x, y, 0])
-    #    for (x, y), r, ca in zip(p, r, ca)
-    # ])
+def _mesh_points_numpy(p, r, ca, sin_u, cos_u, out):
+    """
+    Places circles with radii r around the skeleton points p, evaluated at the angles u along each circle (given as
+    sin_u, cos_u). The result is written to out, an array of shape (len(r) * len(sin_u), 3).
+    """
+    # evaluate the trigonometric functions once per skeleton point, and broadcast them to the
+    # (skeleton point, circle vertex) grid instead of evaluating them for every mesh point
+    sin_ca, cos_ca = _sincos(ca)
+    mesh = out.reshape(len(r), len(sin_u), 3)
+    mesh[..., 0] = r[:, np.newaxis] * cos_u
+    mesh[..., 1] = r[:, np.newaxis] * sin_u * cos_ca[:, np.newaxis]
+    mesh[..., 2] = r[:, np.newaxis] * sin_u * sin_ca[:, np.newaxis]
+    mesh += p[:, np.newaxis, :]
 
-    return mesh, u, v
+
+def _mesh_points_loop(p, r, ca, sin_u, cos_u, out):
+    """
+    Same as _mesh_points_numpy, written as explicit loops to be compiled with numba.
+    """
+    n_circle = sin_u.shape[0]
+    for i in range(r.shape[0]):
+        sin_ca = np.sin(ca[i])
+        cos_ca = np.cos(ca[i])
+        for j in range(n_circle):
+            n = i * n_circle + j
+            out[n, 0] = r[i] * cos_u[j] + p[i, 0]
+            out[n, 1] = r[i] * sin_u[j] * cos_ca + p[i, 1]
+            out[n, 2] = r[i] * sin_u[j] * sin_ca + p[i, 2]
 
 
-def rotate_mesh(mesh, neang):
+if njit is not None:
+    _mesh_points = njit(cache=True, fastmath=True, error_model='numpy')(_mesh_points_loop)
+else:
+    _mesh_points = _mesh_points_numpy
+
+
+def rotate_mesh(mesh, neang, out=None):
     """
     Rotates the GCS mesh into the correct orientation
 
@@ -109,16 +179,50 @@ def rotate_mesh(mesh, neang):
     ----------
     mesh GCS mesh, returned by gcs_mesh
     neang angles: longitude, latitude, and rotation angles (in radians)
+    out: optional array with the shape of the mesh that the rotated mesh is written to (may be the mesh itself)
 
     Returns
     -------
-    rotated GCS mesh
+    rotated GCS mesh (with the same data type)
 
     """
-    return Rotation.from_euler('zyx', [neang[2], neang[1], neang[0]]).apply(mesh)
+    mesh = np.asarray(mesh)
+    return np.matmul(mesh, _rotation_matrix(neang[0], neang[1], neang[2], mesh.dtype).T, out=out)
+
+
+@lru_cache(maxsize=8)
+def _rotation_matrix(lon, lat, tilt, dtype=np.float64):
+    """
+    Rotation matrix used by rotate_mesh. Equivalent to Rotation.from_euler('zyx', [tilt, lat, lon]) in scipy, i.e.
+    rotations by the tilt angle around the Z axis, by the latitude around the Y axis and by the longitude around the
+    X axis, in that order. The matrix is returned with the given data type, so that applying it keeps the data type
+    of the mesh.
+    """
+    sin_lon, cos_lon = _sincos(lon)
+    sin_lat, cos_lat = _sincos(lat)
+    sin_tilt, cos_tilt = _sincos(tilt)
+    rx = np.array([[1, 0, 0], [0, cos_lon, -sin_lon], [0, sin_lon, cos_lon]])
+    ry = np.array([[cos_lat, 0, sin_lat], [0, 1, 0], [-sin_lat, 0, cos_lat]])
+    rz = np.array([[cos_tilt, -sin_tilt, 0], [sin_tilt, cos_tilt, 0], [0, 0, 1]])
+    matrix = (rx @ ry @ rz).astype(dtype)
+    matrix.setflags(write=False)
+    return matrix
+
+
+@lru_cache(maxsize=8)
+def _gcs_mesh_cached(alpha, height, straight_vertices, front_vertices, circle_vertices, k, dtype):
+    """
+    Cached version of gcs_mesh. The mesh only depends on alpha, height and k, so changing the orientation of the CME
+    does not require it to be recomputed. The returned arrays are read-only, as they are shared between calls.
+    """
+    mesh, u, v = gcs_mesh(alpha, height, straight_vertices, front_vertices, circle_vertices, k, dtype)
+    for arr in mesh, u, v:
+        arr.setflags(write=False)
+    return mesh, u, v
 
 
-def gcs_mesh_rotated(alpha, height, straight_vertices, front_vertices, circle_vertices, k, lat, lon, tilt):
+def gcs_mesh_rotated(alpha, height, straight_vertices, front_vertices, circle_vertices, k, lat, lon, tilt,
+                     dtype=np.float64):
     """
     Calculate GCS model mesh and rotate it into the correct orientation.
     Convenience function that combines gcs_mesh and rotate_mesh.
@@ -134,12 +238,13 @@ def gcs_mesh_rotated(alpha, height, straight_vertices, front_vertices, circle_ve
     lat: CME latitude in radians
     lon: CME longitude in radians (0 = Earth-directed)
     tilt: CME tilt angle in radians
+    dtype: data type of the mesh. np.float32 is precise enough for displaying the mesh.
 
     Returns
     -------
     rotated GCS mesh
     """
-    mesh, u, v = gcs_mesh(alpha, height, straight_vertices, front_vertices, circle_vertices, k)
+    mesh, u, v = _gcs_mesh_cached(alpha, height, straight_vertices, front_vertices, circle_vertices, k, dtype)
     mesh = rotate_mesh(mesh, [lon, lat, tilt])
     return mesh, u, v
 
@@ -166,13 +271,93 @@ def gcs_mesh_sunpy(date, alpha, height, straight_vertices, front_vertices, circl
     GCS mesh as SunPy SkyCoord
     """
     mesh, u, v = gcs_mesh_rotated(alpha, height, straight_vertices, front_vertices, circle_vertices, k, lat, lon, tilt)
-    m = mesh.T[[2, 1, 0], :] * sun.constants.radius
-    m[1, :] *= -1
-    mesh_coord = SkyCoord(*(m), frame=frames.HeliographicStonyhurst,
+    return _mesh_to_skycoord(date, mesh)
+
+
+def _mesh_to_skycoord(date, mesh):
+    # reorder the axes and scale to meters in place in a single buffer, which is then wrapped without copying
+    radius = sun.constants.radius
+    m = np.empty((3, len(mesh)))
+    np.multiply(mesh[:, 2], radius.value, out=m[0])
+    np.multiply(mesh[:, 1], -radius.value, out=m[1])
+    np.multiply(mesh[:, 0], radius.value, out=m[2])
+    mesh_coord = SkyCoord(CartesianRepresentation(m << radius.unit, copy=False), frame=frames.HeliographicStonyhurst,
                           obstime=date, representation_type='cartesian')
     return mesh_coord
 
 
+def mesh_transform(date, frame):
+    """
+    Calculates the affine transformation from the coordinate system of the rotated GCS mesh (see gcs_mesh_rotated) to
+    cartesian coordinates in another coordinate frame, e.g. the Helioprojective frame of an image. For a fixed date
+    and frame, this can be used instead of transforming the SkyCoord from gcs_mesh_sunpy each time the mesh changes.
+
+    Parameters
+    ----------
+    date: date and time of observation (Python datetime instance)
+    frame: target coordinate frame
+
+    Returns
+    -------
+    matrix and offset, so that the mesh in the target frame (in meters) is given by mesh @ matrix.T + offset
+    """
+    basis = np.vstack([np.zeros(3), np.eye(3)])
+    xyz = _mesh_to_skycoord(date, basis).transform_to(frame).cartesian.xyz.to_value('m').T
+    offset = xyz[0]
+    matrix = (xyz[1:] - offset).T
+    return matrix, offset
+
+
+def mesh_lonlat(mesh, matrix, offset, out=None):
+    """
+    Transforms the rotated GCS mesh using the affine transformation from mesh_transform and converts it to spherical
+    coordinates.
+
+    Parameters
+    ----------
+    mesh: rotated GCS mesh, returned by gcs_mesh_rotated
+    matrix, offset: affine transformation, returned by mesh_transform
+    out: optional array of shape (2, len(mesh)) that longitude and latitude are written to, e.g. to reuse it
+
+    Returns
+    -------
+    longitude and latitude in the target frame (in degrees)
+    """
+    if out is None:
+        out = np.empty((2, len(mesh)))
+    # one contiguous row each for longitude and latitude
+    lon, lat = out
+    _project(mesh, matrix, offset, lon, lat)
+    return lon, lat
+
+
+def _project_numpy(mesh, matrix, offset, lon, lat):
+    # transformed points as (3, N) array, so that x, y and z are contiguous
+    x, y, z = matrix @ mesh.T + offset[:, np.newaxis]
+    np.arctan2(y, x, out=lon)
+    np.degrees(lon, out=lon)
+    np.arcsin(z / sqrt(x * x + y * y + z * z), out=lat)
+    np.degrees(lat, out=lat)
+
+
+def _project_loop(mesh, matrix, offset, lon, lat):
+    """
+    Same as _project_numpy, written as an explicit loop to be compiled with numba.
+    """
+    for n in range(mesh.shape[0]):
+        x = matrix[0, 0] * mesh[n, 0] + matrix[0, 1] * mesh[n, 1] + matrix[0, 2] * mesh[n, 2] + offset[0]
+        y = matrix[1, 0] * mesh[n, 0] + matrix[1, 1] * mesh[n, 1] + matrix[1, 2] * mesh[n, 2] + offset[1]
+        z = matrix[2, 0] * mesh[n, 0] + matrix[2, 1] * mesh[n, 1] + matrix[2, 2] * mesh[n, 2] + offset[2]
+        lon[n] = math.degrees(math.atan2(y, x))
+        lat[n] = math.degrees(math.asin(z / math.sqrt(x * x + y * y + z * z)))
+
+
+if njit is not None:
+    _project = njit(cache=True, fastmath=True, error_model='numpy')(_project_loop)
+else:
+    _project = _project_numpy
+
+
 def apex_radius(height, k):
     """
     Calculates the cross-section radius of the flux rope at the apex, based on GCS parameters alpha, height and kappa.
@@ -1,46 +1,96 @@
 import argparse
 import datetime as dt
 import json
+import math
 import os
+import pickle
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 from typing import List
 
 import matplotlib
 import numpy as np
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtWidgets import QLabel, QComboBox
 from astropy import units
-from astropy.coordinates import concatenate
 from matplotlib import colors
+from matplotlib.collections import LineCollection
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas, \
     NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 from matplotlib.gridspec import GridSpec
+from matplotlib.transforms import Bbox
 from sunpy import log
 from sunpy.coordinates import get_horizons_coord
 from sunpy.map import Map
 
-from gcs.geometry import gcs_mesh_sunpy, apex_radius
-from gcs.utils.helioviewer import get_helioviewer_client
+from gcs.geometry import gcs_mesh_rotated, apex_radius, mesh_transform, mesh_lonlat
+from gcs.utils.helioviewer import download_jp2, cache_dir, cache_path, discard, enable_parallel_decoding
 from gcs.utils.widgets import SliderAndTextbox
 
 matplotlib.use('Qt5Agg')
 
-hv = get_helioviewer_client()
-
 straight_vertices, front_vertices, circle_vertices = 10, 10, 20
+# coarser mesh that is shown while a slider is being dragged
+drag_straight_vertices, drag_front_vertices, drag_circle_vertices = 5, 5, 10
 filename = 'gcs_params.json'
+# larger images are downsampled, as the figure shows them with far fewer screen pixels anyway
+max_image_size = 1024
 draw_modes = ['off', 'point cloud', 'grid']
+default_params = {
+    'half_angle': 25,
+    'height': 10,
+    'kappa': 0.25,
+    'lat': 0,
+    'lon': 0,
+    'tilt': 0
+}
 
 # disable sunpy warnings
 log.setLevel('ERROR')
 
 
 def running_difference(a, b):
-    return Map(b.data * 1.0 - a.data * 1.0, b.meta)
+    # subtract in a single pass. The difference of 8 bit images (as provided by Helioviewer) fits into int16, otherwise
+    # float32 is sufficient for display.
+    small_ints = (np.uint8, np.int8)
+    dtype = np.int16 if a.data.dtype in small_ints and b.data.dtype in small_ints else np.float32
+    return Map(np.subtract(b.data, a.data, dtype=dtype), b.meta)
 
 
 def load_image(spacecraft: str, detector: str, date: dt.datetime, runndiff: bool):
+    return load_images([spacecraft], [detector], date, runndiff)[0]
+
+
+def load_images(spacecraft: List[str], detectors: List[str], date: dt.datetime, runndiff: bool):
+    # collect all required images, so that they can be downloaded concurrently
+    jobs = []
+    for sc, detector in zip(spacecraft, detectors):
+        observatory, instrument = get_observatory(sc, detector)
+        jobs.append((date, observatory, instrument, detector))
+        if runndiff:
+            jobs.append((date - dt.timedelta(hours=1), observatory, instrument, detector))
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        maps = list(executor.map(lambda job: download_helioviewer(*job), jobs))
+
+    if runndiff:
+        maps = [running_difference(maps[i + 1], maps[i]) for i in range(0, len(maps), 2)]
+    return [reduce_resolution(m, max_image_size) for m in maps]
+
+
+def reduce_resolution(image, max_size):
+    # average blocks of pixels, so that the image is at most max_size pixels wide and high. float32 is sufficient for
+    # display.
+    factor = int(np.ceil(max(image.data.shape) / max_size))
+    if factor <= 1:
+        return image
+    return image.superpixel([factor, factor] * units.pix, func=partial(np.mean, dtype=np.float32))
+
+
+def get_observatory(spacecraft: str, detector: str):
     if spacecraft == 'STA':
         observatory = 'STEREO_A'
         instrument = 'SECCHI'
@@ -58,19 +108,22 @@ def load_image(spacecraft: str, detector: str, date: dt.datetime, runndiff: bool
             raise ValueError(f'unknown detector {detector} for spacecraft {spacecraft}.')
     else:
         raise ValueError(f'unknown spacecraft: {spacecraft}')
-
-    f = download_helioviewer(date, observatory, instrument, detector)
-
-    if runndiff:
-        f2 = download_helioviewer(date - dt.timedelta(hours=1), observatory, instrument, detector)
-        return running_difference(f2, f)
-    else:
-        return f
+    return observatory, instrument
 
 
+@lru_cache(maxsize=16)
 def download_helioviewer(date, observatory, instrument, detector):
-    file = hv.download_jp2(date, observatory=observatory, instrument=instrument, detector=detector)
-    f = Map(file)
+    # the decoded image (including the added observer location) is cached next to the JP2 file
+    map_file = cache_path(date, observatory, instrument, detector) + '.pickle'
+    if os.path.exists(map_file):
+        try:
+            with open(map_file, 'rb') as file:
+                return Map(pickle.load(file))
+        except Exception:
+            # e.g. written by an incompatible version of sunpy, so decode the image again
+            discard(map_file)
+
+    f = read_jp2(date, observatory, instrument, detector)
 
     if observatory == 'SOHO':
        # add observer location information:
@@ -79,9 +132,35 @@ def download_helioviewer(date, observatory, instrument, detector):
        f.meta['HGLT_OBS'] = soho.lat.to('deg').value
        f.meta['DSUN_OBS'] = soho.radius.to('m').value
 
+    # write to a temporary file first, so that other threads or processes never see an incomplete file
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((f.data, f.meta), file)
+        os.replace(tmp_file, map_file)
+    except BaseException:
+        discard(tmp_file)
+        raise
+
     return f
 
 
+def read_jp2(date, observatory, instrument, detector):
+    # a cached JP2 file that cannot be decoded (e.g. truncated) is downloaded again once
+    for retry in (True, False):
+        path = download_jp2(date, observatory, instrument, detector)
+        try:
+            return Map(path)
+        except Exception:
+            discard(path)
+            if not retry:
+                raise
+
+
+def quantize(slider: SliderAndTextbox):
+    return round(slider.val, slider.numbox.decimals())
+
+
 def save_params(params):
     with open(filename, 'w') as file:
         json.dump(params, file)
@@ -89,21 +168,23 @@ def save_params(params):
 
 def load_params():
     if os.path.exists(filename):
-        with open(filename) as file:
-            return json.load(file)
+        return dict(_load_params_file(os.path.getmtime(filename)))
     else:
         # start with default values
-        return {
-            'half_angle': 25,
-            'height': 10,
-            'kappa': 0.25,
-            'lat': 0,
-            'lon': 0,
-            'tilt': 0
-        }
+        return dict(default_params)
+
+
+@lru_cache(maxsize=1)
+def _load_params_file(mtime):
+    # mtime is only used as cache key, so that the file is read again after it has been changed
+    with open(filename) as file:
+        return json.load(file)
 
 
 class GCSGui(QtWidgets.QMainWindow):
+    # emitted when any of the GCS parameters has been changed
+    params_changed = QtCore.pyqtSignal()
+
     def __init__(self, date: dt.datetime, spacecraft: List[str], runndiff: bool = False,
             detector_stereo: str = 'COR2', detector_soho='C2'):
         super().__init__()
@@ -119,9 +200,19 @@ class GCSGui(QtWidgets.QMainWindow):
 
         self._figure = Figure(figsize=(5 * len(spacecraft), 5))
         canvas = FigureCanvas(self._figure)
+        self._canvas = canvas
         self._mainlayout.addWidget(canvas, stretch=5)
         self.addToolBar(NavigationToolbar(canvas, self))
         self._current_draw_mode = None
+        self._bgs = None
+        self._dragging = False
+
+        # coalesce rapid slider changes into a single update of the plot: a zero interval timer fires once all pending
+        # events have been processed, so the plot is updated with the latest values without any added delay
+        self._replot_timer = QtCore.QTimer(self)
+        self._replot_timer.setSingleShot(True)
+        self._replot_timer.setInterval(0)
+        self._replot_timer.timeout.connect(self._do_plot_mesh)
 
         self.create_widgets()
 
@@ -136,12 +227,22 @@ class GCSGui(QtWidgets.QMainWindow):
         self._s_lat = SliderAndTextbox('Heliographic Latitude, \u03B8 [°]', -90, 90, params['lat'])
         self._s_lon = SliderAndTextbox('Stonyhurst Longitude, \u03C6 [°]', 0, 360, params['lon'])
         self._s_tilt = SliderAndTextbox('Tilt angle, \u03B3 [°]', -90, 90, params['tilt'])
-        sliders = self._s_half_angle, self._s_height, self._s_kappa, self._s_lat, self._s_lon, self._s_tilt
+        self._param_sliders = {
+            'half_angle': self._s_half_angle,
+            'height': self._s_height,
+            'kappa': self._s_kappa,
+            'lat': self._s_lat,
+            'lon': self._s_lon,
+            'tilt': self._s_tilt
+        }
 
         layout = QtWidgets.QVBoxLayout()
-        for slider in sliders:
+        for slider in self._param_sliders.values():
             layout.addWidget(slider)
-            slider.valueChanged.connect(self.plot_mesh)
+            slider.valueChanged.connect(self.params_changed)
+            slider.sliderPressed.connect(self._start_drag)
+            slider.sliderReleased.connect(self._end_drag)
+        self.params_changed.connect(self.plot_mesh)
 
         # add checkbox to enable or disable plot
         cb_mode_label = QLabel()
@@ -173,40 +274,89 @@ class GCSGui(QtWidgets.QMainWindow):
         spec = GridSpec(ncols=len(spacecraft), nrows=1, figure=fig)
 
         axes = []
-        images = []
         self._mesh_plots = []
-        for i, sc in enumerate(spacecraft):
-            detector = self._detector_stereo if sc in ['STA', 'STB'] else self._detector_soho
-            image = load_image(sc, detector, date, runndiff)
-            images.append(image)
-
+        detectors = [self._detector_stereo if sc in ['STA', 'STB'] else self._detector_soho for sc in spacecraft]
+        images = load_images(spacecraft, detectors, date, runndiff)
+        norm = colors.Normalize(vmin=-30, vmax=30) if runndiff else None
+        for i, image in enumerate(images):
             ax = fig.add_subplot(spec[:, i], projection=image)
             axes.append(ax)
 
-            image.plot(axes=ax, cmap='Greys_r', norm=colors.Normalize(vmin=-30, vmax=30) if runndiff else None)
+            image.plot(axes=ax, cmap='Greys_r', norm=norm)
 
             if i == len(spacecraft) - 1:
                 # for last plot: move labels to the right
                 ax.coords[1].set_ticks_position('r')
                 ax.coords[1].set_ticklabel_position('r')
                 ax.coords[1].set_axislabel_position('r')
-        self._bg = fig.canvas.copy_from_bbox(fig.bbox)
         self._images = images
         self._axes = axes
-
-        self.plot_mesh()
+        # the image frames are fixed, so they and the transformation of the mesh into them only need to be
+        # computed once
+        self._coord_frames = [image.coordinate_frame for image in images]
+        self._mesh_transforms = [mesh_transform(date, frame) for frame in self._coord_frames]
+        self._wcs = [image.wcs for image in images]
+        # projected mesh points of each image, reused for every update: longitude and latitude as separate rows,
+        # sized for the full resolution mesh
+        n_points = ((front_vertices + straight_vertices) * 2 - 3) * circle_vertices
+        self._lonlat_bufs = [np.empty((2, n_points), dtype=np.float32) for _ in images]
+
+        # the mesh plots are animated, i.e. only drawn on top of a saved background when the mesh changes
+        fig.canvas.mpl_connect('draw_event', self._on_draw)
+        self._do_plot_mesh()
 
         fig.canvas.draw()
         fig.tight_layout()
 
+    def _on_draw(self, event):
+        if event is not None and (event.canvas is not self._canvas or event.canvas.is_saving()):
+            # drawn by savefig, on a temporary canvas for another format or at another resolution
+            return
+        # the figure has been redrawn (e.g. after resizing), so save the new backgrounds of the axes. The mesh plots
+        # are clipped to the axes, so only these regions need to be updated later.
+        self._bgs = [self._figure.canvas.copy_from_bbox(self._blit_bbox(ax)) for ax in self._axes]
+        for plots in self._mesh_plots:
+            for p in plots:
+                p.axes.draw_artist(p)
+
+    @staticmethod
+    def _blit_bbox(ax):
+        # include the outermost pixels touched by antialiased lines at the edge of the axes
+        return ax.bbox.padded(2)
+
+    def _blit_mesh_plots(self):
+        if self._bgs is None:
+            # figure has not been drawn yet
+            return
+        canvas = self._figure.canvas
+        for i, (ax, bg) in enumerate(zip(self._axes, self._bgs)):
+            canvas.restore_region(bg)
+            if i < len(self._mesh_plots):
+                for p in self._mesh_plots[i]:
+                    ax.draw_artist(p)
+        # a single blit covering all axes, so that the widget is repainted only once
+        canvas.blit(Bbox.union([self._blit_bbox(ax) for ax in self._axes]))
+
     def plot_mesh(self):
-        fig = self._figure
-        half_angle = np.radians(self._s_half_angle.val)
-        height = self._s_height.val
-        kappa = self._s_kappa.val
-        lat = np.radians(self._s_lat.val)
-        lon = np.radians(self._s_lon.val)
-        tilt = np.radians(self._s_tilt.val)
+        if not self._replot_timer.isActive():
+            self._replot_timer.start()
+
+    def _start_drag(self):
+        self._dragging = True
+
+    def _end_drag(self):
+        # show the full resolution mesh again
+        self._dragging = False
+        self.plot_mesh()
+
+    def _do_plot_mesh(self):
+        # quantize to slider resolution, so that the cached GCS mesh is reused when the same values come up again
+        half_angle = math.radians(quantize(self._s_half_angle))
+        height = quantize(self._s_height)
+        kappa = quantize(self._s_kappa)
+        lat = math.radians(quantize(self._s_lat))
+        lon = math.radians(quantize(self._s_lon))
+        tilt = math.radians(quantize(self._s_tilt))
 
         # calculate and show quantities
         ra = apex_radius(height, kappa)
@@ -215,56 +365,57 @@ class GCSGui(QtWidgets.QMainWindow):
         # check if plot should be shown
         draw_mode = draw_modes[self._cb_mode.currentIndex()]
         if draw_mode != self._current_draw_mode:
-            for plot in self._mesh_plots:
-                plot.remove()
+            for plots in self._mesh_plots:
+                for p in plots:
+                    p.remove()
             self._mesh_plots = []
-            fig.canvas.draw()
             self._current_draw_mode = draw_mode
-            if draw_mode == 'off':
-                return
+        if draw_mode == 'off':
+            self._blit_mesh_plots()
+            return
+
+        # create GCS mesh, with less vertices while a slider is dragged
+        if self._dragging:
+            sv, fv, cv = drag_straight_vertices, drag_front_vertices, drag_circle_vertices
+        else:
+            sv, fv, cv = straight_vertices, front_vertices, circle_vertices
+        mesh, u, v = gcs_mesh_rotated(half_angle, height, sv, fv, cv, kappa, lat, lon, tilt, dtype=np.float32)
+        n_points = len(mesh)
+
+        for i, (transform, wcs, lonlat, ax) in enumerate(zip(self._mesh_transforms, self._wcs, self._lonlat_bufs,
+                                                             self._axes)):
+            # project to the image directly, instead of going through the WCSAxes world transform on every draw
+            lonlat = lonlat[:, :n_points]
+            mesh_lonlat(mesh, *transform, out=lonlat)
+            xdata, ydata = wcs.world_to_pixel_values(*lonlat)
+            if draw_mode == 'grid':
+                # circles around the skeleton, and the lines connecting them (same points, transposed)
+                circles = np.stack((xdata, ydata), -1).reshape(n_points // cv, cv, 2)
+                segments = circles, circles.transpose(1, 0, 2)
 
-        # create GCS mesh
-        mesh = gcs_mesh_sunpy(self._date, half_angle, height, straight_vertices, front_vertices, circle_vertices,
-                              kappa, lat, lon, tilt)
-        if draw_mode == 'grid':
-            mesh2 = mesh.reshape((front_vertices + straight_vertices) * 2 - 3, circle_vertices).T.flatten()
-            mesh = concatenate([mesh, mesh2])
-
-        for i, (image, ax) in enumerate(zip(self._images, self._axes)):
             if len(self._mesh_plots) <= i:
                 # new plot
-                style = {
-                    'grid': '-',
-                    'point cloud': '.'
-                }[draw_mode]
-                params = {
-                    'grid': dict(lw=0.5),
-                    'point cloud': dict(ms=2)
-                }[draw_mode]
-                p = ax.plot_coord(mesh, style, color='blue', scalex=False, scaley=False, **params)[0]
-                self._mesh_plots.append(p)
+                if draw_mode == 'grid':
+                    plots = [ax.add_collection(LineCollection(seg, colors='blue', lw=0.5, animated=True,
+                                                              transform=ax.get_transform('pixel')), autolim=False)
+                             for seg in segments]
+                else:
+                    plots = ax.plot(xdata, ydata, '.', color='blue', ms=2, scalex=False, scaley=False, animated=True,
+                                    transform=ax.get_transform('pixel'))
+                self._mesh_plots.append(plots)
             else:
                 # update plot
-                p = self._mesh_plots[i]
-
-                frame0 = mesh.frame.transform_to(image.coordinate_frame)
-                xdata = frame0.spherical.lon.to_value(units.deg)
-                ydata = frame0.spherical.lat.to_value(units.deg)
-                p.set_xdata(xdata)
-                p.set_ydata(ydata)
-                ax.draw_artist(p)
+                if draw_mode == 'grid':
+                    for p, seg in zip(self._mesh_plots[i], segments):
+                        p.set_segments(seg)
+                else:
+                    p, = self._mesh_plots[i]
+                    p.set_data(xdata, ydata)
 
-        fig.canvas.draw()
+        self._blit_mesh_plots()
 
     def get_params_dict(self):
-        return {
-            'half_angle': self._s_half_angle.val,
-            'height': self._s_height.val,
-            'kappa': self._s_kappa.val,
-            'lat': self._s_lat.val,
-            'lon': self._s_lon.val,
-            'tilt': self._s_tilt.val
-        }
+        return {name: slider.val for name, slider in self._param_sliders.items()}
 
     def save(self):
         save_params(self.get_params_dict())
@@ -285,6 +436,7 @@ def main():
     parser.add_argument('-stereo', type=str, default='COR2', choices=['COR1', 'COR2'],
                         help='Which coronagraph to use at STEREO.')
     args = parser.parse_args()
+    enable_parallel_decoding()
     qapp = QtWidgets.QApplication(sys.argv)
     app = GCSGui(args.date, args.spacecraft, args.running_difference, detector_stereo=args.stereo,
                  detector_soho=args.soho)
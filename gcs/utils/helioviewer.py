@@ -1,13 +1,146 @@
+import hashlib
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import requests
+import sunpy
+from requests.adapters import HTTPAdapter
 from sunpy.net.helioviewer import HelioviewerClient
 
+# time after which the online check is repeated when the client is requested again (in seconds)
+client_ttl = 3600
+# directory in which downloaded images are kept across sessions
+cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'gcs_python')
+# signature box at the start of every JP2 file
+jp2_signature = b'\x00\x00\x00\x0cjP  \r\n\x87\n'
+
+_client = None
+_client_time = None
+# images are downloaded from several threads at once
+_client_lock = threading.Lock()
+
 
 def get_helioviewer_client():
-    hv = HelioviewerClient()
+    # the client is created on first use and then shared, so that the online check only happens once in a while
+    global _client, _client_time
+    with _client_lock:
+        if _client is None or time.monotonic() - _client_time > client_ttl:
+            _client = _create_helioviewer_client()
+            _client_time = time.monotonic()
+        return _client
+
+
+def download_jp2(date, observatory, instrument, detector):
+    """
+    Downloads the JP2 image closest to the given date from Helioviewer, unless it has been downloaded before.
+
+    Returns
+    -------
+    path of the JP2 file in the cache directory
+    """
+    path = cache_path(date, observatory, instrument, detector) + '.jp2'
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # download into a separate directory for each request, as concurrent requests (e.g. for running differences)
+        # can resolve to the same file on the server
+        staging_dir = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            file = get_helioviewer_client().download_jp2(date, observatory=observatory, instrument=instrument,
+                                                         detector=detector, directory=staging_dir)
+            # only keep actual JP2 files, and not e.g. error messages returned instead of the image
+            with open(file, 'rb') as f:
+                if f.read(len(jp2_signature)) != jp2_signature:
+                    raise ValueError(f'Helioviewer did not return a JP2 image for {observatory} {instrument} '
+                                     f'{detector} at {date}')
+            os.replace(file, path)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    return path
+
+
+def discard(path):
+    """
+    Removes a file that turned out to be unreadable from the cache, so that it is created again on the next request.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        # already removed, e.g. by another thread
+        pass
+
+
+def enable_parallel_decoding():
+    """
+    Lets OpenJPEG use all CPU cores for decoding JP2 images. This needs glymur >= 0.9.3 and OpenJPEG >= 2.2.0, with
+    older versions the images are decoded single-threaded as before.
+    """
+    try:
+        import glymur
+        glymur.set_option('lib.num_threads', os.cpu_count())
+    except (ImportError, KeyError, RuntimeError):
+        pass
+
+
+def cache_path(date, observatory, instrument, detector):
+    """
+    Path in the cache directory for files belonging to the given image request (without file extension).
+    """
+    key = '_'.join([observatory, instrument, detector, date.isoformat()])
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+
+class SessionHelioviewerClient(HelioviewerClient):
+    """
+    HelioviewerClient that sends all requests through one requests.Session, so that the connection to the server is
+    kept alive and reused for subsequent requests instead of doing a new TCP/TLS handshake each time.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # only pass on what the caller gave: up to sunpy 3.0 the default URL is fixed, from 3.1 on None probes the
+        # known servers
+        super().__init__(*args, **kwargs)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    # _request and _get_file override private methods of HelioviewerClient, which was deprecated in sunpy 4.1. They
+    # mirror the signatures and return values of these methods in sunpy 2.1 to 5.1, the versions allowed in
+    # requirements.txt, and need to be checked when that range changes.
+    def _request(self, params):
+        response = self._session.post(self._api, data=params)
+        response.raise_for_status()
+        return io.BytesIO(response.content)
+
+    def _get_file(self, params, progress=True, directory=None, overwrite=False):
+        if directory is None:
+            directory = Path(sunpy.config.get('downloads', 'download_dir'))
+        else:
+            directory = Path(directory).expanduser().absolute()
+
+        response = self._session.get(self._api, params=params)
+        response.raise_for_status()
+        match = re.search(r'filename="?([^";]+)"?', response.headers.get('Content-Disposition', ''))
+        path = directory / (match.group(1) if match else 'helioviewer.jp2')
+        if overwrite or not path.exists():
+            directory.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(response.content)
+        return str(path)
+
+
+def _create_helioviewer_client():
+    hv = SessionHelioviewerClient()
     if not _is_online(hv):
         # fall back to mirror server
         print("https://www.helioviewer.org/ seems to be offline,"
               "switching to mirror at https://helioviewer.ias.u-psud.fr/")
-        hv = HelioviewerClient("https://helioviewer-api.ias.u-psud.fr/")
+        hv = SessionHelioviewerClient("https://helioviewer-api.ias.u-psud.fr/")
     return hv
 
 
@@ -15,4 +148,4 @@ def _is_online(hv: HelioviewerClient):
     try:
         return hv.is_online()
     except:
-        return False
\ No newline at end of file
+        return False
@@ -11,6 +11,8 @@ class SliderAndTextbox(QtWidgets.QWidget):
     def __init__(self, label, min, max, init, resolution=0.01):
         super(SliderAndTextbox, self).__init__()
         self.resolution = resolution
+        # set while one of the two controls is being updated from the other one
+        self._syncing = False
 
         self.slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
         self.slider.setMinimum(int(min / resolution))
@@ -38,6 +40,8 @@ class SliderAndTextbox(QtWidgets.QWidget):
         vlayout.addLayout(layout)
 
         self.valueChanged = self.numbox.valueChanged
+        self.sliderPressed = self.slider.sliderPressed
+        self.sliderReleased = self.slider.sliderReleased
 
     @property
     def val(self):
@@ -45,15 +49,28 @@ class SliderAndTextbox(QtWidgets.QWidget):
 
     @QtCore.pyqtSlot(int)
     def handleSliderValueChange(self, value):
-        self.numbox.setValue(value * self.resolution)
-
+        if self._syncing:
+            return
+        self._syncing = True
+        try:
+            self.numbox.setValue(value * self.resolution)
+        finally:
+            self._syncing = False
 
     @QtCore.pyqtSlot(float)
     def handleNumboxValueChange(self, value):
-        # Prevent values outside slider range
-        if value < self.slider.minimum():
-            self.numbox.setValue(self.slider.minimum())
-        elif value > self.slider.maximum():
-            self.numbox.setValue(self.slider.maximum())
+        if self._syncing:
+            return
+        self._syncing = True
+        try:
+            # Prevent values outside slider range
+            if value < self.slider.minimum():
+                self.numbox.setValue(self.slider.minimum())
+            elif value > self.slider.maximum():
+                self.numbox.setValue(self.slider.maximum())
 
-        self.slider.setValue(int(round(self.numbox.value() / self.resolution)))
+            # the numbox already has the new value, so the slider does not need to report back
+            with QtCore.QSignalBlocker(self.slider):
+                self.slider.setValue(int(round(self.numbox.value() / self.resolution)))
+        finally:
+            self._syncing = False
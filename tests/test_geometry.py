@@ -0,0 +1,27 @@
+import datetime as dt
+
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from sunpy.coordinates import frames
+
+from gcs import geometry
+
+
+@pytest.mark.skipif(geometry.njit is None, reason='numba is not installed')
+def test_project_degenerate_mesh():
+    # at kappa = 1 (the slider maximum) the mesh contains non-finite points, which the compiled kernel has to turn
+    # into NaN like the NumPy version instead of raising ZeroDivisionError
+    mesh, u_, v = geometry.gcs_mesh_rotated(np.radians(30), 10, 10, 10, 20, 1, 0, 0, 0, dtype=np.float32)
+    date = dt.datetime(2020, 4, 15)
+    observer = SkyCoord(0 * u.deg, 0 * u.deg, 1 * u.AU, frame=frames.HeliographicStonyhurst, obstime=date)
+    matrix, offset = geometry.mesh_transform(date, frames.Helioprojective(observer=observer, obstime=date))
+
+    result = np.empty((2, len(mesh)))
+    expected = np.empty((2, len(mesh)))
+    geometry._project(mesh, matrix, offset, *result)
+    geometry._project_numpy(mesh, matrix, offset, *expected)
+
+    assert np.isnan(expected).any()
+    np.testing.assert_allclose(result, expected)